@@ -15,32 +15,46 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import re
 import sigma
 from .base import SingleTextQueryBackend
 from .mixins import MultiRuleOutputMixin
 
+# value types accepted as leaf nodes and map values, compared by exact type so that bool is rejected
+_STR_INT = (str, int)
+_STR_INT_LIST = (str, int, list)
+
 
 class QRadarBackend(SingleTextQueryBackend):
     """Converts Sigma rule into Qradar saved search. Contributed by SOC Prime. https://socprime.com"""
     identifier = "qradar"
     active = True
-    reEscape = re.compile('(")')
-    reClear = None
     andToken = " and "
     orToken = " or "
     notToken = "not "
     subExpression = "(%s)"
     listExpression = "%s"
     listSeparator = " "
-    valueExpression = "\'%s\'"
     keyExpression = "%s"
-    nullExpression = "%s is null"
-    notNullExpression = "not (%s is null)"
-    mapExpression = "%s=%s"
     mapListsSpecialHandling = True
     aql_database = "events"
 
+    # node type -> name of the generator method, looked up once per node in generateNode
+    _DISPATCH = {
+        sigma.parser.condition.ConditionAND: "generateANDNode",
+        sigma.parser.condition.ConditionOR: "generateORNode",
+        sigma.parser.condition.ConditionNOT: "generateNOTNode",
+        sigma.parser.condition.ConditionNULLValue: "generateNULLValueNode",
+        sigma.parser.condition.ConditionNotNULLValue: "generateNotNULLValueNode",
+        sigma.parser.condition.NodeSubexpression: "generateSubexpressionNode",
+        tuple: "generateMapItemNode",
+        list: "generateListNode",
+    }
+    _WILDCARD_TABLE = str.maketrans({"*": "%"})          # Sigma wildcard -> AQL ilike wildcard
+    _ESCAPE_TABLE = str.maketrans({'"': '\\"'})          # characters that must be escaped -> escaped form
+    _ESCAPE_CHARS = frozenset(map(chr, _ESCAPE_TABLE))   # values without any of these are already clean
+    _PREFIX_EVENTS = "SELECT UTF8(payload) as search_payload from events where "
+    _PREFIX_FLOWS = "SELECT UTF8(payload) as search_payload from flows where "
+
     def cleanKey(self, key):
         if " " in key:
             key = "\"%s\"" % (key)
@@ -48,79 +62,73 @@ class QRadarBackend(SingleTextQueryBackend):
         else:
             return key
 
+    def cleanValue(self, val):
+        # escaping is defined by _ESCAPE_TABLE instead of reEscape/reClear and done in a single pass
+        return val.translate(self._ESCAPE_TABLE)
+
     def generateNode(self, node):
-        if type(node) == sigma.parser.condition.ConditionAND:
-            return self.generateANDNode(node)
-        elif type(node) == sigma.parser.condition.ConditionOR:
-            return self.generateORNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNOT:
-            return self.generateNOTNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNULLValue:
-            return self.generateNULLValueNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
-            return self.generateNotNULLValueNode(node)
-        elif type(node) == sigma.parser.condition.NodeSubexpression:
-            return self.generateSubexpressionNode(node)
-        elif type(node) == tuple:
-            return self.generateMapItemNode(node)
-        elif type(node) in (str, int):
+        method = self._DISPATCH.get(type(node))
+        if method is not None:
+            return getattr(self, method)(node)
+        elif type(node) in _STR_INT:
             return self.generateValueNode(node, False)
-        elif type(node) == list:
-            return self.generateListNode(node)
         else:
             raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
 
-
     def generateMapItemNode(self, node):
         key, value = node
-        if self.mapListsSpecialHandling == False and type(value) in (str, int, list) or self.mapListsSpecialHandling == True and type(value) in (str, int):
+        if self.mapListsSpecialHandling == False and type(value) in _STR_INT_LIST or self.mapListsSpecialHandling == True and type(value) in _STR_INT:
             if type(value) == str and "*" in value:
-                value = value.replace("*", "%")
-                return "%s ilike %s" % (self.cleanKey(key), self.generateValueNode(value, True))
-            elif type(value) in (str, int):
-                return self.mapExpression % (self.cleanKey(key), self.generateValueNode(value, True))
+                value = value.translate(self._WILDCARD_TABLE)
+                return self.cleanKey(key) + " ilike " + self.generateValueNode(value, True)
+            elif type(value) in _STR_INT:
+                return self.cleanKey(key) + "=" + self.generateValueNode(value, True)
             else:
-                return self.mapExpression % (self.cleanKey(key), self.generateNode(value))
+                return self.cleanKey(key) + "=" + self.generateNode(value)
         elif type(value) == list:
             return self.generateMapItemListNode(key, value)
         else:
             raise TypeError("Backend does not support map values of type " + str(type(value)))
 
     def generateMapItemListNode(self, key, value):
-        itemslist = list()
+        key = self.cleanKey(key)
+        equals = list()
+        conditions = list()
         for item in value:
             if type(item) == str and "*" in item:
-                item = item.replace("*", "%")
-                itemslist.append('%s ilike %s' % (self.cleanKey(key), self.generateValueNode(item, True)))
+                conditions.append(key + ' ilike ' + self.generateValueNode(item.translate(self._WILDCARD_TABLE), True))
             else:
-                itemslist.append('%s = %s' % (self.cleanKey(key), self.generateValueNode(item, True)))
-        return '('+" or ".join(itemslist)+')'
+                equals.append(self.generateValueNode(item, True))
+        if len(equals) > 1:         # plain values are collapsed into one IN clause
+            conditions.insert(0, key + ' IN (' + ", ".join(equals) + ')')
+        elif equals:
+            conditions.insert(0, key + ' = ' + equals[0])
+        return '('+" or ".join(conditions)+')'
 
     def generateValueNode(self, node, keypresent):
+        value = node if type(node) == str else str(node)
+        if not self._ESCAPE_CHARS.isdisjoint(value):
+            value = self.cleanValue(value)
         if keypresent == False:
-            return "UTF8(payload) ilike \'{0}{1}{2}\'".format("%", self.cleanValue(str(node)), "%")
+            return "UTF8(payload) ilike '%" + value + "%'"
         else:
-            return self.valueExpression % (self.cleanValue(str(node)))
+            return "'" + value + "'"
 
     def generateNULLValueNode(self, node):
-        return self.nullExpression % (node.item)
+        return node.item + " is null"
 
     def generateNotNULLValueNode(self, node):
-        return self.notNullExpression % (node.item)
+        return "not (" + node.item + " is null)"
 
     def generateAggregation(self, agg):
         if agg == None:
             return ""
         if agg.aggfunc == sigma.parser.condition.SigmaAggregationParser.AGGFUNC_NEAR:
             raise NotImplementedError("The 'near' aggregation operator is not yet implemented for this backend")
-        if agg.groupfield == None:
-            self.qradarPrefixAgg = "SELECT %s(%s) as agg_val from %s where" % (agg.aggfunc_notrans, agg.aggfield, self.aql_database)
-            self.qradarSuffixAgg = " group by %s having agg_val %s %s" % (agg.aggfield, agg.cond_op, agg.condition)
-            return self.qradarPrefixAgg, self.qradarSuffixAgg
-        else:
-            self.qradarPrefixAgg = " SELECT %s(%s) as agg_val from %s where " % (agg.aggfunc_notrans, agg.aggfield, self.aql_database)
-            self.qradarSuffixAgg = " group by %s having agg_val %s %s" % (agg.groupfield, agg.cond_op, agg.condition)
-            return self.qradarPrefixAgg, self.qradarSuffixAgg
+        groupfield = agg.groupfield or agg.aggfield
+        prefix = "SELECT %s(%s) as agg_val from %s where " % (agg.aggfunc_notrans, agg.aggfield, self.aql_database)
+        suffix = " group by %s having agg_val %s %s" % (groupfield, agg.cond_op, agg.condition)
+        return prefix, suffix
 
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
@@ -141,12 +149,8 @@ class QRadarBackend(SingleTextQueryBackend):
 
     def generateQuery(self, parsed, sigmaparser):
         result = self.generateNode(parsed.parsedSearch)
-        self.parsedlogsource = sigmaparser.get_logsource().index
-        if any("flow" in i for i in self.parsedlogsource):
-            aql_database = "flows"
-        else:
-            aql_database = "events"
-        qradarPrefix = "SELECT UTF8(payload) as search_payload from %s where " % (aql_database)
+        isflow = any("flow" in i for i in sigmaparser.get_logsource().index)
+        qradarPrefix = self._PREFIX_FLOWS if isflow else self._PREFIX_EVENTS
         if parsed.parsedAgg:
             (qradarPrefix, qradarSuffixAgg) = self.generateAggregation(parsed.parsedAgg)
             result = qradarPrefix + result
@@ -14,11 +14,25 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+from collections import OrderedDict
 import yaml
 from sigma.parser.condition import ConditionAND, ConditionOR
 from sigma.config.exceptions import SigmaConfigParseError
 from sigma.config.mapping import FieldMapping
 
+def _single_or_none(values, kind):
+    """Return the only value that is not None or None if there is none. Differing values raise ValueError."""
+    first = None
+    for value in values:
+        if value is None:
+            continue
+        if first is None:
+            first = value
+        elif value != first:
+            raise ValueError("Merged SigmaLogsourceConfigurations must have disjunct %s (%s, %s)" % (kind, first, value))
+    return first
+
 # Configuration
 class SigmaConfiguration:
     """Sigma converter configuration. Contains field mappings and logsource descriptions"""
@@ -30,43 +44,51 @@ class SigmaConfiguration:
             self.logsourcemerging = SigmaLogsourceConfiguration.MM_AND
             self.defaultindex = None
             self.backend = None
+            self._fieldmapping_cache = dict()
+            self._logsource_index = dict()
         else:
             config = yaml.safe_load(configyaml)
             self.config = config
 
             self.fieldmappings = dict()
-            try:
-                for source, target in config['fieldmappings'].items():
-                    self.fieldmappings[source] = FieldMapping(source, target)
-            except KeyError:
-                pass
+            for source, target in config.get('fieldmappings', {}).items():
+                self.fieldmappings[source] = FieldMapping(source, target)
             if type(self.fieldmappings) != dict:
                 raise SigmaConfigParseError("Fieldmappings must be a map")
 
-            try:
-                self.logsourcemerging = config['logsourcemerging']
-            except KeyError:
-                self.logsourcemerging = SigmaLogsourceConfiguration.MM_AND
-
-            try:
-                self.defaultindex = config['defaultindex']
-            except KeyError:
-                self.defaultindex = None
+            self.logsourcemerging = config.get('logsourcemerging', SigmaLogsourceConfiguration.MM_AND)
+            self.defaultindex = config.get('defaultindex')
 
             self.logsources = list()
             self.backend = None
+            self._fieldmapping_cache = dict()
+            self._logsource_index = dict()      # (category, product, service) of log source -> [ (position, log source) ]
 
     def get_fieldmapping(self, fieldname):
         """Return mapped fieldname if mapping defined or field name given in parameter value"""
         try:
-            return self.fieldmappings[fieldname]
+            return self._fieldmapping_cache[fieldname]
         except KeyError:
-            return FieldMapping(fieldname)
+            pass
+        if fieldname in self.fieldmappings:
+            mapping = self.fieldmappings[fieldname]
+        else:
+            mapping = FieldMapping(fieldname)
+        self._fieldmapping_cache[fieldname] = mapping
+        return mapping
 
     def get_logsource(self, category, product, service):
         """Return merged log source definition of all logosurces that match criteria"""
-        matching = [logsource for logsource in self.logsources if logsource.matches(category, product, service)]
-        return SigmaLogsourceConfiguration(matching, self.defaultindex)
+        # A log source matches if each of its criteria is either undefined (None) or equal to the searched one. Look up
+        # the search criteria with every combination of them replaced by None and keep the configuration order.
+        try:
+            keys = set(itertools.product((category, None), (product, None), (service, None)))
+        except TypeError:       # unhashable criteria (e.g. lists in the rule) can't be looked up: check each log source
+            matching = [logsource for logsource in self.logsources if logsource.matches(category, product, service)]
+        else:
+            matching = sorted((entry for key in keys for entry in self._logsource_index.get(key, ())), key=lambda entry: entry[0])
+            matching = [logsource for position, logsource in matching]
+        return SigmaLogsourceConfiguration.merge(matching, self.defaultindex)
 
     def set_backend(self, backend):
         """Set backend. This is used by other code to determine target properties for index addressing"""
@@ -77,7 +99,10 @@ class SigmaConfiguration:
                 if type(logsources) != dict:
                     raise SigmaConfigParseError("Logsources must be a map")
                 for name, logsource in logsources.items():
-                    self.logsources.append(SigmaLogsourceConfiguration(logsource, self.defaultindex, name, self.logsourcemerging, self.get_indexfield()))
+                    logsourceconfig = SigmaLogsourceConfiguration.from_dict(logsource, name, self.get_indexfield())
+                    key = (logsourceconfig.category, logsourceconfig.product, logsourceconfig.service)
+                    self._logsource_index.setdefault(key, []).append((len(self.logsources), logsourceconfig))
+                    self.logsources.append(logsourceconfig)
 
     def get_indexfield(self):
         """Get index condition if index field name is configured"""
@@ -92,124 +117,114 @@ class SigmaLogsourceConfiguration:
     def __init__(self, logsource=None, defaultindex=None, name=None, mergemethod=MM_AND, indexfield=None):
         self.name = name
         self.indexfield = indexfield
-        if logsource == None:               # create empty object
-            self.category = None
-            self.product = None
-            self.service = None
-            self.index = list()
-            self.conditions = None
-        elif type(logsource) == list and all([isinstance(o, SigmaLogsourceConfiguration) for o in logsource]):      # list of SigmaLogsourceConfigurations: merge according to mergemethod
-            # Merge category, product and service
-            categories = set([ ls.category for ls in logsource if ls.category != None ])
-            products = set([ ls.product for ls in logsource if ls.product != None ])
-            services = set([ ls.service for ls in logsource if ls.service != None])
-            if len(categories) > 1 or len(products) > 1 or len(services) > 1:
-                raise ValueError("Merged SigmaLogsourceConfigurations must have disjunct categories (%s), products (%s) and services (%s)" % (str(categories), str(products), str(services)))
-
-            try:
-                self.category = categories.pop()
-            except KeyError:
-                self.category = None
-            try:
-                self.product = products.pop()
-            except KeyError:
-                self.product = None
-            try:
-                self.service = services.pop()
-            except KeyError:
-                self.service = None
-
-            # Merge all index patterns
-            self.index = list(set([index for ls in logsource for index in ls.index]))       # unique(flat(logsources.index))
-            if len(self.index) == 0 and defaultindex is not None:   # if no index pattern matched and default index is present: use default index
-                if type(defaultindex) == str:
-                    self.index = [defaultindex]
-                elif type(defaultindex) == list and all([type(i) == str for i in defaultindex]):
-                    self.index = defaultindex
-                else:
-                    raise TypeError("Default index must be string or list of strings")
-
-            # "merge" index field (should never differ between instances because it is provided by backend class
-            indexfields = [ ls.indexfield for ls in logsource if ls.indexfield != None ]
-            try:
-                self.indexfield = indexfields[0]
-            except IndexError:
-                self.indexfield = None
-
-            # Merge conditions according to mergemethod
-            if mergemethod == self.MM_AND:
-                cond = ConditionAND()
-            elif mergemethod == self.MM_OR:
-                cond = ConditionOR()
-            else:
-                raise ValueError("Mergemethod must be '%s' or '%s'" % (self.MM_AND, self.MM_OR))
-            for ls in logsource:
-                if ls.conditions != None:
-                    cond.add(ls.conditions)
-            if len(cond) > 0:
-                self.conditions = cond
-            else:
-                self.conditions = None
+        self.category = None
+        self.product = None
+        self.service = None
+        self.index = list()
+        self.conditions = None
+        if logsource is None:               # create empty object
+            return
+        if type(logsource) == list and all([isinstance(o, SigmaLogsourceConfiguration) for o in logsource]):      # list of SigmaLogsourceConfigurations: merge according to mergemethod
+            self._merge(logsource, defaultindex, mergemethod)
         elif type(logsource) == dict:       # create logsource configuration from parsed yaml
-            if 'category' in logsource and type(logsource['category']) != str \
-                    or 'product' in logsource and type(logsource['product']) != str \
-                    or 'service' in logsource and type(logsource['service']) != str:
-                raise SigmaConfigParseError("Logsource category, product or service must be a string")
-            try:
-                self.category = logsource['category']
-            except KeyError:
-                self.category = None
-            try:
-                self.product = logsource['product']
-            except KeyError:
-                self.product = None
-            try:
-                self.service = logsource['service']
-            except KeyError:
-                self.service = None
-            if self.category == None and self.product == None and self.service == None:
-                raise SigmaConfigParseError("Log source definition will not match")
-
-            if 'index' in logsource:
-                index = logsource['index']
-                if type(index) not in (str, list):
-                    raise SigmaConfigParseError("Logsource index must be string or list of strings")
-                if type(index) == list and not all([type(index) == str for index in logsource['index']]):
-                    raise SigmaConfigParseError("Logsource index patterns must be strings")
-                if type(index) == list:
-                    self.index = index
-                else:
-                    self.index = [ index ]
+            self._parse(logsource)
+        else:
+            raise SigmaConfigParseError("Logsource definitions must be maps")
+
+    @classmethod
+    def from_dict(cls, logsource, name=None, indexfield=None):
+        """Create log source configuration from parsed yaml"""
+        if type(logsource) != dict:
+            raise SigmaConfigParseError("Logsource definitions must be maps")
+        lsconfig = cls(name=name, indexfield=indexfield)
+        lsconfig._parse(logsource)
+        return lsconfig
+
+    @classmethod
+    def merge(cls, logsources, defaultindex=None, mergemethod=MM_AND):
+        """Merge list of SigmaLogsourceConfigurations according to mergemethod"""
+        lsconfig = cls()
+        lsconfig._merge(logsources, defaultindex, mergemethod)
+        return lsconfig
+
+    def _merge(self, logsource, defaultindex, mergemethod):
+        # Merge category, product and service
+        self.category = _single_or_none((ls.category for ls in logsource), "categories")
+        self.product = _single_or_none((ls.product for ls in logsource), "products")
+        self.service = _single_or_none((ls.service for ls in logsource), "services")
+
+        # Merge all index patterns
+        self.index = list(OrderedDict.fromkeys(index for ls in logsource for index in ls.index))       # unique(flat(logsources.index)) in order of first occurrence
+        if len(self.index) == 0 and defaultindex is not None:   # if no index pattern matched and default index is present: use default index
+            if type(defaultindex) == str:
+                self.index = [defaultindex]
+            elif type(defaultindex) == list and all([type(i) == str for i in defaultindex]):
+                self.index = defaultindex
             else:
-                # no default index handling here - this branch is executed if log source definitions are parsed from
-                # config and these must not necessarily contain an index definition. A valid index may later be result
-                # from a merge, where default index handling applies.
-                self.index = []
-
-            if 'conditions' in logsource:
-                if type(logsource['conditions']) != dict:
-                    raise SigmaConfigParseError("Logsource conditions must be a map")
-                cond = ConditionAND()
-                for key, value in logsource['conditions'].items():
-                    cond.add((key, value))
-                self.conditions = cond
+                raise TypeError("Default index must be string or list of strings")
+
+        # "merge" index field (should never differ between instances because it is provided by backend class
+        self.indexfield = next((ls.indexfield for ls in logsource if ls.indexfield != None), None)
+
+        # Merge conditions according to mergemethod
+        if mergemethod == self.MM_AND:
+            cond = ConditionAND()
+        elif mergemethod == self.MM_OR:
+            cond = ConditionOR()
+        else:
+            raise ValueError("Mergemethod must be '%s' or '%s'" % (self.MM_AND, self.MM_OR))
+        for ls in logsource:
+            if ls.conditions != None:
+                cond.add(ls.conditions)
+        if len(cond) > 0:
+            self.conditions = cond
+        else:
+            self.conditions = None
+
+    def _parse(self, logsource):
+        if 'category' in logsource and type(logsource['category']) != str \
+                or 'product' in logsource and type(logsource['product']) != str \
+                or 'service' in logsource and type(logsource['service']) != str:
+            raise SigmaConfigParseError("Logsource category, product or service must be a string")
+        self.category = logsource.get('category')
+        self.product = logsource.get('product')
+        self.service = logsource.get('service')
+        if self.category == None and self.product == None and self.service == None:
+            raise SigmaConfigParseError("Log source definition will not match")
+
+        if 'index' in logsource:
+            index = logsource['index']
+            if type(index) not in (str, list):
+                raise SigmaConfigParseError("Logsource index must be string or list of strings")
+            if type(index) == list and not all([type(index) == str for index in logsource['index']]):
+                raise SigmaConfigParseError("Logsource index patterns must be strings")
+            if type(index) == list:
+                self.index = index
             else:
-                self.conditions = None
+                self.index = [ index ]
         else:
-            raise SigmaConfigParseError("Logsource definitions must be maps")
+            # no default index handling here - this branch is executed if log source definitions are parsed from
+            # config and these must not necessarily contain an index definition. A valid index may later be result
+            # from a merge, where default index handling applies.
+            self.index = []
+
+        if 'conditions' in logsource:
+            if type(logsource['conditions']) != dict:
+                raise SigmaConfigParseError("Logsource conditions must be a map")
+            cond = ConditionAND()
+            for key, value in logsource['conditions'].items():
+                cond.add((key, value))
+            self.conditions = cond
+        else:
+            self.conditions = None
 
     def matches(self, category, product, service):
         """Match log source definition against given criteria, None = ignore"""
-        searched = 0
-        for searchval, selfval in zip((category, product, service), (self.category, self.product, self.service)):
-            if searchval == None and selfval != None:
-                return False
-            if selfval != None:
-                searched += 1
-                if searchval != selfval:
-                    return False
-        if searched:
-            return True
+        if self.category is None and self.product is None and self.service is None:
+            return False
+        return (self.category is None or self.category == category) \
+                and (self.product is None or self.product == product) \
+                and (self.service is None or self.service == service)
 
     def get_indexcond(self):
         """Get index condition if index field name is configured"""